@@ -1,11 +1,19 @@
-from typing import Callable, Any, List, get_type_hints, NamedTuple
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    get_type_hints,
+)
 import inspect
-from collections import defaultdict
 from enum import Enum
 
 from pkg_resources import DistributionNotFound, get_distribution
 
-from ._compat import is_generic_list, ensure_forward_ref
+from ._compat import is_generic_list, ensure_forward_ref, has_forward_ref
 
 try:  # pragma no cover
     __version__ = get_distribution(__name__).version
@@ -96,12 +104,101 @@ class Scope(Enum):
     singleton = 1
 
 
-class Registration(NamedTuple):
+class Registration:
+    __slots__ = (
+        "service",
+        "scope",
+        "builder",
+        "needs",
+        "args",
+        "build",
+    )
+
     service: str
     scope: Scope
     builder: Callable[[], Any]
     needs: Any
     args: List[Any]
+    build: Callable[["Container", dict, "ResolutionContext"], Any]
+
+    def __init__(self, service, scope, builder, needs, args, build=None):
+        if build is None:
+            build = _compile_build(
+                builder,
+                _get_needs_items(needs, args),
+                args,
+                _get_target_args(builder),
+            )
+        self.service = service
+        self.scope = scope
+        self.builder = builder
+        self.needs = needs
+        self.args = args
+        self.build = build
+
+    def __repr__(self):
+        return (
+            "Registration(service=%r, scope=%r, builder=%r, needs=%r, args=%r)"
+            % (self.service, self.scope, self.builder, self.needs, self.args)
+        )
+
+
+def _get_target_args(builder):
+    """Return the names of the arguments we may pass to a builder.
+
+    Builders whose signature can't be inspected, such as some builtins, are
+    given no resolution arguments rather than being rejected.
+    """
+    try:
+        spec = inspect.getfullargspec(builder)
+    except TypeError:
+        return ()
+    return tuple(a for a in spec.args if a != "self")
+
+
+def _get_needs_items(needs, fixed_args):
+    """Return the (name, type) pairs that must be resolved for a builder."""
+    return tuple(
+        (name, dependency)
+        for name, dependency in needs.items()
+        if name != "return" and name not in fixed_args
+    )
+
+
+def _compile_build(builder, needs_items, fixed_args, target_args):
+    """Specialize the construction of a registration into a single function.
+
+    Everything that only depends on the registration is worked out here, so
+    that resolving the service is left with building the arguments and calling
+    the builder.
+    """
+    target_arg_set = frozenset(target_args)
+
+    def build(container, resolution_args, context):
+        # Registration kwargs are never resolved, so they seed the arguments.
+        args = dict(fixed_args)
+        for name, dependency in needs_items:
+            if name in resolution_args:
+                continue
+            # Skip the recursive resolution when the dependency is already built.
+            instance = container._singletons.get(dependency, empty)
+            if instance is empty:
+                instance = context.cache.get(dependency, empty)
+            if instance is empty:
+                instance = container._resolve_impl(dependency, resolution_args, context)
+            args[name] = instance
+        if resolution_args:
+            args.update(
+                {
+                    key: value
+                    for key, value in resolution_args.items()
+                    if key in target_arg_set
+                }
+            )
+
+        return builder(**args)
+
+    return build
 
 
 class Empty:
@@ -113,15 +210,69 @@ empty = Empty()
 
 class Registry:
     def __init__(self):
-        self.__registrations = defaultdict(list)
+        self.__registrations = {}
         self._localns = dict()
+        self._needs_cache = dict()
+        self._forward_ref_ctors = set()
+        self._target_args_cache = dict()
 
-    def _get_needs_for_ctor(self, cls):
+    def _get_type_hints(self, cls):
         try:
             return get_type_hints(cls.__init__, None, self._localns)
         except NameError as e:
             raise InvalidForwardReferenceException(str(e))
 
+    def _get_needs_for_ctor(self, cls):
+        """Return the type hints for a constructor, memoized per class.
+
+        Hints that contain forward references are resolved through our local
+        namespace, so `invalidate` drops those entries whenever that namespace
+        changes.
+        """
+        try:
+            return self._needs_cache[cls]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable factories can't be memoized.
+            return self._get_type_hints(cls)
+
+        needs = self._needs_cache[cls] = self._get_type_hints(cls)
+        annotations = getattr(cls.__init__, "__annotations__", {})
+        if any(has_forward_ref(a) for a in annotations.values()):
+            self._forward_ref_ctors.add(cls)
+        return needs
+
+    def _get_args_for_builder(self, builder):
+        """Return the argument names for a builder, memoized per builder.
+
+        Unlike the constructor hints these never depend on our local
+        namespace, so they survive `invalidate`.
+        """
+        try:
+            return self._target_args_cache[builder]
+        except KeyError:
+            target_args = self._target_args_cache[builder] = _get_target_args(builder)
+            return target_args
+        except TypeError:
+            # Unhashable factories can't be memoized.
+            return _get_target_args(builder)
+
+    def invalidate(self):
+        for cls in self._forward_ref_ctors:
+            del self._needs_cache[cls]
+        self._forward_ref_ctors.clear()
+
+    def _create_registration(self, service, scope, builder, needs, args, target_args):
+        return Registration(
+            service,
+            scope,
+            builder,
+            needs,
+            args,
+            _compile_build(builder, _get_needs_items(needs, args), args, target_args),
+        )
+
     def register_service_and_impl(self, service, scope, impl, resolve_args):
         """Registers a concrete implementation of an abstract service.
 
@@ -146,9 +297,14 @@ class Registry:
                 >>> instance.send("Hello")
                 Sending message via smtp: Hello
         """
-        self.__registrations[service].append(
-            Registration(
-                service, scope, impl, self._get_needs_for_ctor(impl), resolve_args
+        self.__registrations.setdefault(service, []).append(
+            self._create_registration(
+                service,
+                scope,
+                impl,
+                self._get_needs_for_ctor(impl),
+                resolve_args,
+                self._get_args_for_builder(impl),
             )
         )
 
@@ -176,8 +332,10 @@ class Registry:
             ... )
             <punq.Container object at 0x...>
         """
-        self.__registrations[service].append(
-            Registration(service, Scope.singleton, lambda: instance, {}, {})
+        self.__registrations.setdefault(service, []).append(
+            self._create_registration(
+                service, Scope.singleton, lambda: instance, {}, {}, ()
+            )
         )
 
     def register_concrete_service(self, service, scope):
@@ -202,24 +360,31 @@ class Registry:
                 "The service %s can't be registered as its own implementation"
                 % (repr(service))
             )
-        self.__registrations[service].append(
-            Registration(service, scope, service, self._get_needs_for_ctor(service), {})
+        self.__registrations.setdefault(service, []).append(
+            self._create_registration(
+                service,
+                scope,
+                service,
+                self._get_needs_for_ctor(service),
+                {},
+                self._get_args_for_builder(service),
+            )
         )
 
-    def build_context(self, key, existing=None):
-        if existing is None:
-            return ResolutionContext(key, list(self.__getitem__(key)))
-
-        if key not in existing.targets:
-            existing.targets[key] = ResolutionTarget(key, list(self.__getitem__(key)))
-
-        return existing
+    def build_context(
+        self, key: Any, resolving: Optional[Set[Registration]] = None
+    ) -> "ResolutionContext":
+        return ResolutionContext(key, self.__getitem__(key), resolving)
 
     def _update_localns(self, service):
         if type(service) == type:
-            self._localns[service.__name__] = service
+            name = service.__name__
         else:
-            self._localns[service] = service
+            name = service
+
+        if self._localns.get(name, empty) != service:
+            self._localns[name] = service
+            self.invalidate()
 
     def register(
         self, service, factory=empty, instance=empty, scope=Scope.transient, **kwargs
@@ -238,50 +403,51 @@ class Registry:
             )
 
         self._update_localns(service)
-        ensure_forward_ref(self, service, factory, instance, **kwargs)
+        if isinstance(service, str):
+            ensure_forward_ref(self, service, factory, instance, **kwargs)
 
-    def __getitem__(self, service):
-        return self.__registrations[service]
+    def __getitem__(self, service: Any) -> Sequence[Registration]:
+        return self.__registrations.get(service, ())
 
 
 class ResolutionTarget:
     def __init__(self, key, impls):
         self.service = key
+        # Registrations are only ever appended, so we can walk the registry's
+        # own list backwards instead of copying it.
         self.impls = impls
+        self._index = len(impls)
+        self._is_generic_list = is_generic_list(key)
+        self._generic_parameter = key.__args__[0] if self._is_generic_list else None
 
     def is_generic_list(self):
-        return is_generic_list(self.service)
+        return self._is_generic_list
 
     @property
     def generic_parameter(self):
-        return self.service.__args__[0]
+        return self._generic_parameter
 
-    def next_impl(self):
-        if len(self.impls) > 0:
-            return self.impls.pop()
+    def next_impl(self) -> Optional[Registration]:
+        if self._index > 0:
+            self._index -= 1
+            return self.impls[self._index]
 
 
 class ResolutionContext:
-    def __init__(self, key, impls):
+    def __init__(self, key, impls, resolving=None):
         self.targets = {key: ResolutionTarget(key, impls)}
         self.cache = {}
         self.service = key
+        # Registrations being built, shared with the contexts opened to
+        # resolve list dependencies so that cycles through them are caught.
+        self.resolving = set() if resolving is None else resolving
 
     def target(self, key):
         return self.targets.get(key)
 
-    def has_cached(self, key):
-        return key in self.cache
-
-    def __getitem__(self, key):
-        return self.cache.get(key)
-
     def __setitem__(self, key, instance):
         self.cache[key] = instance
 
-    def all_registrations(self, service):
-        return self.targets[service].impls
-
 
 class Container:
     """
@@ -295,6 +461,10 @@ class Container:
         self.registrations = Registry()
         self.register(Container, instance=self)
         self._singletons = {}
+        # Singletons by registration, so that every registration of a service
+        # keeps its own instance; _singletons holds the latest per service.
+        # Registrations live as long as the registry, so their ids are stable.
+        self._registration_singletons = {}
 
     def register(
         self, service, factory=empty, instance=empty, scope=Scope.transient, **kwargs
@@ -399,69 +569,95 @@ class Container:
             ...         if authn.matches(req):
             ...             return authn.authenticate(req)
         """
-        context = self.registrations.build_context(service)
+        return self._resolve_all_impl(service, kwargs, None)
 
-        return [
-            self._build_impl(x, kwargs, context)
-            for x in context.all_registrations(service)
-        ]
+    def _resolve_all_impl(self, service, kwargs, resolving):
+        impls = self.registrations[service]
+        context = ResolutionContext(service, impls, resolving)
 
-    def _build_impl(self, registration, resolution_args, context):
+        if len(impls) == 1:
+            return [self._build_impl(impls[0], kwargs, context)]
+
+        return [self._build_impl(x, kwargs, context) for x in impls]
+
+    def _build_impl(
+        self,
+        registration: Registration,
+        resolution_args: Dict[str, Any],
+        context: "ResolutionContext",
+    ) -> Any:
         """Instantiate the registered service.
         """
 
-        args = {
-            k: self._resolve_impl(v, resolution_args, context)
-            for k, v in registration.needs.items()
-            if k != "return" and k not in registration.args and k not in resolution_args
-        }
-        args.update(registration.args)
+        if registration.scope == Scope.singleton:
+            instance = self._registration_singletons.get(id(registration), empty)
+            if instance is not empty:
+                return instance
 
-        target_args = inspect.getfullargspec(registration.builder).args
-        if "self" in target_args:
-            target_args.remove("self")
-        condensed_resolution_args = {
-            key: resolution_args[key] for key in resolution_args if key in target_args
-        }
-        args.update(condensed_resolution_args or {})
+        if registration in context.resolving:
+            raise InvalidRegistrationException(
+                "Circular dependency detected while resolving "
+                + str(registration.service)
+            )
 
-        result = registration.builder(**args)
+        context.resolving.add(registration)
+        try:
+            result = registration.build(self, resolution_args, context)
+        finally:
+            context.resolving.discard(registration)
 
         if registration.scope == Scope.singleton:
             self._singletons[registration.service] = result
+            self._registration_singletons[id(registration)] = result
 
         context[registration.service] = result
 
         return result
 
-    def _resolve_impl(self, service_key, kwargs, context):
-
-        context = self.registrations.build_context(service_key, context)
-
+    def _resolve_impl(
+        self, service_key: Any, kwargs: Dict[str, Any], context: "ResolutionContext"
+    ) -> Any:
         if service_key in self._singletons:
             return self._singletons[service_key]
 
-        if context.has_cached(service_key):
-            return context[service_key]
+        if service_key not in context.targets:
+            context.targets[service_key] = ResolutionTarget(
+                service_key, self.registrations[service_key]
+            )
+
+        cached = context.cache.get(service_key, empty)
+        if cached is not empty:
+            return cached
 
         target = context.target(service_key)
 
         if target.is_generic_list():
-            return self.resolve_all(target.generic_parameter)
+            return self._resolve_all_impl(
+                target.generic_parameter, {}, context.resolving
+            )
 
         registration = target.next_impl()
 
         if registration is None:
+            # A finished build is cached on the context, so running out of
+            # registrations we do have means every one of them is still being
+            # built further up the stack.
+            if target.impls:
+                raise InvalidRegistrationException(
+                    "Circular dependency detected while resolving " + str(service_key)
+                )
             raise MissingDependencyException(
                 "Failed to resolve implementation for " + str(service_key)
             )
 
-        if service_key in registration.needs.values():
-            self._resolve_impl(service_key, kwargs, context)
-
         return self._build_impl(registration, kwargs, context)
 
     def resolve(self, service_key, **kwargs):
+        # Singletons are returned before resolution args are considered, so a
+        # cached instance needs no resolution context at all.
+        if service_key in self._singletons:
+            return self._singletons[service_key]
+
         context = self.registrations.build_context(service_key)
 
         return self._resolve_impl(service_key, kwargs, context)
@@ -18,5 +18,12 @@ def is_generic_list(service):
 
 
 def ensure_forward_ref(self, service, factory, instance, **kwargs):
-    if isinstance(service, str):
-        self.register(ForwardRef(service), factory, instance, **kwargs)
+    self.register(ForwardRef(service), factory, instance, **kwargs)
+
+
+def has_forward_ref(annotation):
+    if isinstance(annotation, (str, ForwardRef)):
+        return True
+    # Unparameterized generics have __args__ = None on Python 3.6.
+    args = getattr(annotation, "__args__", None) or ()
+    return any(has_forward_ref(arg) for arg in args)
@@ -6,6 +6,7 @@ from tempfile import NamedTemporaryFile
 import os
 from punq import (
     Container,
+    Registration,
     Scope,
     InvalidRegistrationException,
     MissingDependencyException,
@@ -21,6 +22,30 @@ from tests.test_dependencies import (
 )
 
 
+class Chicken:
+    def __init__(self, egg: "Egg") -> None:
+        self.egg = egg
+
+
+class Egg:
+    def __init__(self, chicken: Chicken) -> None:
+        self.chicken = chicken
+
+
+class Bird:
+    pass
+
+
+class Flock:
+    def __init__(self, birds: List[Bird]) -> None:
+        self.birds = birds
+
+
+class FlockingBird(Bird):
+    def __init__(self, flock: Flock) -> None:
+        self.flock = flock
+
+
 def test_can_create_instance_with_no_dependencies():
     container = Container()
     container.register(MessageWriter, StdoutMessageWriter)
@@ -205,3 +230,89 @@ def test_can_use_a_string_key():
     container = Container()
     container.register("foo", instance=1)
     assert container.resolve("foo") == 1
+
+
+class Inbox:
+    def __init__(self, messages: List) -> None:
+        self.messages = messages
+
+
+def test_can_register_a_constructor_annotated_with_a_bare_generic():
+    container = Container()
+    container.register(Inbox, Inbox, messages=["hello"])
+    container.register(Inbox, Inbox, messages=["world"])
+
+    expect(container.resolve(Inbox).messages).to(equal(["world"]))
+
+
+def test_resolve_all_reuses_singletons():
+    container = Container()
+    container.register(MessageWriter, StdoutMessageWriter, scope=Scope.singleton)
+
+    writer = container.resolve(MessageWriter)
+    [resolved] = container.resolve_all(MessageWriter)
+
+    expect(resolved).to(be(writer))
+
+
+def test_resolve_all_keeps_one_instance_per_singleton_registration():
+    container = Container()
+    container.register(MessageWriter, StdoutMessageWriter, scope=Scope.singleton)
+    container.register(
+        MessageWriter, TmpFileMessageWriter, path="my-file", scope=Scope.singleton
+    )
+
+    [first, second] = container.resolve_all(MessageWriter)
+    [third, fourth] = container.resolve_all(MessageWriter)
+
+    expect(first).to(be_a(StdoutMessageWriter))
+    expect(second).to(be_a(TmpFileMessageWriter))
+    expect(third).to(be(first))
+    expect(fourth).to(be(second))
+
+
+def test_can_register_a_builder_without_an_inspectable_signature():
+    container = Container()
+    container.register("settings", dict)
+
+    expect(container.resolve("settings")).to(equal({}))
+
+
+def test_container_resolves_itself():
+    container = Container()
+
+    expect(container.resolve(Container)).to(be(container))
+    expect(container.resolve(Container)).to(be(container))
+    expect(container.resolve_all(Container)).to(equal([container]))
+
+
+def test_registration_can_be_created_from_its_original_fields():
+    registration = Registration(
+        MessageWriter, Scope.transient, StdoutMessageWriter, {}, {}
+    )
+
+    expect(repr(registration)).to(
+        equal(
+            "Registration(service=%r, scope=%r, builder=%r, needs={}, args={})"
+            % (MessageWriter, Scope.transient, StdoutMessageWriter)
+        )
+    )
+    expect(registration.build(Container(), {}, None)).to(be_a(StdoutMessageWriter))
+
+
+def test_circular_dependencies_raise_exception():
+    container = Container()
+    container.register(Egg)
+    container.register(Chicken)
+
+    with pytest.raises(InvalidRegistrationException):
+        container.resolve(Chicken)
+
+
+def test_circular_dependencies_through_a_list_raise_exception():
+    container = Container()
+    container.register(Flock)
+    container.register(Bird, FlockingBird)
+
+    with pytest.raises(InvalidRegistrationException):
+        container.resolve(Flock)
@@ -8,6 +8,8 @@ get_type_hints function, so that we can resolve forward references to any
 previously registered service.
 """
 
+from typing import get_type_hints
+
 import attr
 
 import punq
@@ -63,3 +65,40 @@ def test_forward_references_can_be_registered_as_strings():
 
     instance = container.resolve(Client)
     assert instance.dep.val == 2
+
+
+def test_registering_a_forward_reference_refreshes_cached_hints():
+    """
+    We memoize constructor hints per class, but registering a new forward
+    reference can change what those hints resolve to, so a later registration
+    must see the new target.
+    """
+    container = punq.Container()
+    container.register(Dependency)
+    container.register(Client)
+    container.register("Dependency", DataAccessLayer)
+    container.register(Client)
+
+    instance = container.resolve(Client)
+    assert instance.dep.val == 2
+
+
+def test_constructor_hints_are_shared_across_services(monkeypatch):
+    """
+    Constructors without forward references don't depend on what else is
+    registered, so registering the same implementation under many services
+    only inspects it once.
+    """
+    calls = []
+
+    def counting_get_type_hints(*args, **kwargs):
+        calls.append(args)
+        return get_type_hints(*args, **kwargs)
+
+    monkeypatch.setattr(punq, "get_type_hints", counting_get_type_hints)
+
+    container = punq.Container()
+    for i in range(50):
+        container.register("service-%d" % i, DataAccessLayer)
+
+    assert len(calls) == 1